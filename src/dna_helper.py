@@ -24,35 +24,271 @@ COMPLEMENT_AMBIGOUS_DNA :
     bases.
 AMB_REGEX_DICT : dict
     The dictionary containing the corresponding regex string for each possible
-    base, including ambiguity bases.
+    upper case base, including ambiguity bases.
+NUMPY_HAMMING_MIN_LEN : int
+    Shortest sequence length for which the hamming distance is computed with
+    numpy; shorter sequences are compared in plain python.
+BIT_PARALLEL_HAMMING_MIN_LEN : int
+    Shortest pure ACGT sequence length for which the hamming distance is
+    computed bit-parallel; below it the encoding costs more than it saves.
 
 """
 
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, partial
+
+import numpy as np
 import regex
 
-from textdistance import hamming
+try:
+    from rapidfuzz.distance import Hamming
+except ImportError:     # fall back to the pure python/numpy distance
+    Hamming = None
+try:
+    import hyperscan
+except ImportError:     # fall back to regex for exact matches
+    hyperscan = None
 
 DNA_UNAMBIGUOUS_CHARS = "ACGTUNIacgtuni"
 DNA_UNAMBIGUOUS_REV = "TGCAANItgcaani"
 DNA_AMBIGUOUS_CHARS = "ACGTURYSWKMBDHVNIacgturyswkmbdhvni"
-DNA_AMBIGUOUS_REV = "TGCAAYRWSMKVHDBNItgcaayrwsmkvhdbni"
-# COMPLEMENT_UNAMBIGOUS_DNA = maketrans(DNA_UNAMBIGUOUS_CHARS,
-#                                       DNA_UNAMBIGUOUS_REV)
-# COMPLEMENT_AMBIGOUS_DNA = maketrans(DNA_AMBIGUOUS_CHARS, DNA_AMBIGUOUS_REV)
+DNA_AMBIGUOUS_REV = "TGCAAYRSWMKVHDBNItgcaayrswmkvhdbni"
+COMPLEMENT_UNAMBIGOUS_DNA = str.maketrans(DNA_UNAMBIGUOUS_CHARS,
+                                          DNA_UNAMBIGUOUS_REV)
+COMPLEMENT_AMBIGOUS_DNA = str.maketrans(DNA_AMBIGUOUS_CHARS, DNA_AMBIGUOUS_REV)
+_BYTES_COMPLEMENT_UNAMBIGOUS_DNA = bytes.maketrans(
+    DNA_UNAMBIGUOUS_CHARS.encode("ascii"), DNA_UNAMBIGUOUS_REV.encode("ascii"))
+_BYTES_COMPLEMENT_AMBIGOUS_DNA = bytes.maketrans(
+    DNA_AMBIGUOUS_CHARS.encode("ascii"), DNA_AMBIGUOUS_REV.encode("ascii"))
 
 # SUBSET = {"A": "A", "C": "C", "G": "G", "T": "T", "U": "U", "R": "AG",
 #         "Y": "CT", "S": "GC", "W": "AT", "K": "GT", "M": "AC", "B": "CGTYSK",
 #         "D": "AGTRWK", "V": "ACTYWM", "H": "ACGRSM",
 #         "N": "ACGTURYSWKMBDHVNI", "I": "ACGTURYSWKMBDHVNI"}
-AMB_REGEX_DICT = {"A": r"A", "a": r"a", "C": r"C", "c": r"c", "G": r"G",
-                  "g": r"g", "T": r"T", "t": r"t", "U": r"U", "u": r"u",
-                  "R": r"[AG]", "r": r"[ag]", "Y": r"[CT]", "y": r"[ct]",
-                  "S": r"[GC]", "s": r"[gc]", "W": r"[AT]", "w": r"[at]",
-                  "K": r"[GT]", "k": r"[gt]", "M": r"[AC]", "m": r"[AC]",
-                  "B": r"[CGT]", "b": r"[cgt]", "D": r"[AGT]", "d": r"[agt]",
-                  "V": r"[ACT]", "v": r"[act]", "H": r"[ACG]", "h": r"[acg]",
-                  "N": r"[ACGT]", "n": r"[acgt]", "I": r"[ACGT]",
-                  "i": r"[acgt]"}
+AMB_REGEX_DICT = {"A": r"A", "C": r"C", "G": r"G", "T": r"T", "U": r"U",
+                  "R": r"[AG]", "Y": r"[CT]", "S": r"[GC]", "W": r"[AT]",
+                  "K": r"[GT]", "M": r"[AC]", "B": r"[CGT]", "D": r"[AGT]",
+                  "V": r"[ACT]", "H": r"[ACG]", "N": r"[ACGT]",
+                  "I": r"[ACGT]"}
+# Lower case bases expand to lower case sets, used when preserving case.
+_AMB_REGEX_ALL_CASES = dict(AMB_REGEX_DICT,
+                            **{base.lower(): rgx.lower()
+                               for base, rgx in AMB_REGEX_DICT.items()})
+_AMB_TRANS = str.maketrans(_AMB_REGEX_ALL_CASES)
+_ALLOWED = frozenset(_AMB_REGEX_ALL_CASES)
+_UPPER_TABLE = bytes.maketrans(b"acgturyswkmbdhvni", b"ACGTURYSWKMBDHVNI")
+NUMPY_HAMMING_MIN_LEN = 64
+BIT_PARALLEL_HAMMING_MIN_LEN = 32
+_TWO_BIT_TABLE = bytes.maketrans(b"ACGT", b"\x00\x01\x02\x03")
+
+
+def _as_bytes(sequence):
+    """Return the dna sequence as ascii bytes, it may already be bytes."""
+    if isinstance(sequence, bytes):
+        return(sequence)
+    return(sequence.encode("ascii"))
+
+
+def _encode2bit(sequence):
+    """Encode a pure ACGT sequence as an int with one 2 bit code per byte.
+
+    Returns None if the sequence contains anything other than A, C, G or T.
+
+    """
+    seq_bytes = _as_bytes(sequence)
+    if seq_bytes.translate(None, b"ACGT"):
+        return(None)
+    return(int.from_bytes(seq_bytes.translate(_TWO_BIT_TABLE), "big"))
+
+
+@lru_cache(maxsize=None)
+def _low_bit_mask(length):
+    """Return an int with the lowest bit of each of length bytes set."""
+    return(int.from_bytes(b"\x01" * length, "big"))
+
+
+@lru_cache(maxsize=None)
+def _numba_hamming_kernel():
+    """Return the numba hamming kernel, or None if numba is not installed.
+
+    numba is only needed when rapidfuzz is missing, and is slow to import
+    and compile, so both are done on first use.
+
+    """
+    try:
+        from numba import njit
+    except ImportError:     # fall back to numpy for long sequences
+        return(None)
+
+    @njit(cache=True, boundscheck=False)
+    def hamming_numba(tarr, sarr):
+        """Count the differing positions of two equal length uint8 arrays."""
+        dist = 0
+        for i in range(tarr.size):
+            dist += tarr[i] != sarr[i]
+        return(dist)
+
+    return(hamming_numba)
+
+
+def _ambig_regex_body(sequence, preserve_case):
+    """Validate a dna sequence and expand its ambiguity bases to sets."""
+    if not _ALLOWED.issuperset(sequence):
+        bad_char = next(c for c in sequence if c not in _ALLOWED)
+        raise KeyError(bad_char + " is not an allowed DNA character.")
+    if not preserve_case:   # convert to upper case if not preserve case
+        sequence = sequence.encode("ascii").translate(_UPPER_TABLE).decode()
+    return(sequence.translate(_AMB_TRANS))
+
+
+class _hyperscan_match(object):
+    """Span of a hyperscan match, with the regex match methods we use."""
+
+    __slots__ = ("_start", "_end")
+
+    def __init__(self, start, end):
+        self._start = start
+        self._end = end
+
+    def start(self):
+        return(self._start)
+
+    def end(self):
+        return(self._end)
+
+    def span(self):
+        return((self._start, self._end))
+
+
+class _hyperscan_pattern(object):
+    """Exact dna pattern compiled into a hyperscan block mode database.
+
+    Every base of the pattern matches exactly one character, so all matches
+    have the length of the dna sequence. Hyperscan reports the end offset of
+    every match, overlapping ones included; finditer keeps the leftmost
+    non-overlapping ones, which is what regex finditer returns.
+
+    """
+
+    def __init__(self, body, length):
+        self._length = length
+        self._db = hyperscan.Database(mode=hyperscan.HS_MODE_BLOCK)
+        self._db.compile(expressions=[body.encode("ascii")])
+        # scratch space can not be shared by concurrent scans
+        self._local = threading.local()
+
+    def finditer(self, target_dna):
+        """Iterate over the non-overlapping matches in target_dna."""
+        scratch = getattr(self._local, "scratch", None)
+        if scratch is None:
+            scratch = self._local.scratch = hyperscan.Scratch(self._db)
+        ends = []
+        self._db.scan(_as_bytes(target_dna),
+                      match_event_handler=_collect_hyperscan_end,
+                      context=ends, scratch=scratch)
+        length = self._length
+        cur_end = 0
+        for end in ends:
+            start = end - length
+            if start >= cur_end:
+                cur_end = end
+                yield _hyperscan_match(start, end)
+
+
+def _collect_hyperscan_end(pattern_id, start, end, flags, ends):
+    """Hyperscan match callback, records the end offset of each match."""
+    ends.append(end)
+
+
+@lru_cache(maxsize=4096)
+def _compile_ambig_regex(sequence, mismatches, preserve_case,
+                         engine="regex"):
+    """Compile the ambiguity regex for a dna sequence.
+
+    Cached worker behind dna_utility.conv_ambig_regex, so that the same
+    primer is only compiled once per run. Compiled patterns are safe to share
+    between threads. A bytes sequence gives a bytes pattern.
+
+    """
+    if engine not in ("regex", "hyperscan"):
+        raise ValueError("Unknown regex engine " + engine + ".")
+    is_bytes = isinstance(sequence, bytes)
+    if is_bytes:    # latin-1 never fails, bad bytes raise the KeyError below
+        sequence = sequence.decode("latin-1")
+    body = _ambig_regex_body(sequence, preserve_case)
+    if mismatches == 0:
+        if engine == "hyperscan" and hyperscan is not None:
+            return(_hyperscan_pattern(body, len(sequence)))
+        # A fuzzy match with no substitutions is an exact match, so skip the
+        # fuzzy matching machinery altogether. Matches are the same.
+        dna_regex = f"(?:{body})"
+        flags = regex.VERSION1
+    else:
+        dna_regex = f"({body}){{s<={mismatches}}}"
+        # best match set, passed as flags so the inline (?b) is not parsed
+        flags = regex.BESTMATCH | regex.VERSION1
+    if is_bytes:
+        dna_regex = dna_regex.encode("ascii")
+    dna_regex = regex.compile(dna_regex, flags=flags)
+    return dna_regex
+
+
+def _first_match(finditer, target_dna):
+    """Return (start, end, count) of the first of the non-overlapping matches.
+
+    finditer is the bound finditer method of a compiled pattern.
+
+    """
+    matches = finditer(target_dna)
+    first = next(matches, None)
+    if first is None:
+        return((-1, -1, 0))
+    number_found = 1 + sum(1 for _ in matches)
+    return((first.start(), first.end(), number_found))
+
+
+def _last_match(finditer, target_dna):
+    """Return (start, end, count) of the last of the non-overlapping matches.
+
+    finditer is the bound finditer method of a compiled pattern.
+
+    """
+    last = None
+    number_found = 0
+    for match in finditer(target_dna):
+        last = match.span()
+        number_found += 1
+    if last is None:
+        return((-1, -1, 0))
+    return((last[0], last[1], number_found))
+
+
+@lru_cache(maxsize=4096)
+def _make_matcher(sequence, mismatches, preserve_case, last,
+                  engine="regex", concurrent=False):
+    """Build a match function specialised to one dna sequence.
+
+    The compiled pattern's finditer is bound once, so each call skips the
+    regex lookup and attribute access done by find_first_match and
+    find_last_match. With concurrent set, the regex module releases the GIL
+    while matching.
+
+    """
+    pattern = _compile_ambig_regex(sequence, mismatches, preserve_case,
+                                   engine)
+    finditer = pattern.finditer
+    if concurrent and not isinstance(pattern, _hyperscan_pattern):
+        finditer = partial(finditer, concurrent=True)
+    if last:
+        return(partial(_last_match, finditer))
+    return(partial(_first_match, finditer))
+
+
+def _match_chunk(matcher, reads):
+    """Run a matcher over a chunk of reads, for the thread pool."""
+    return([matcher(read) for read in reads])
 
 
 class dna_utility(object):
@@ -63,7 +299,8 @@ class dna_utility(object):
     """
 
     @staticmethod
-    def conv_ambig_regex(sequence, mismatches=0, preserve_case=False):
+    def conv_ambig_regex(sequence, mismatches=0, preserve_case=False,
+                         engine="regex"):
         """Convert the ambigous bases to regular expressions.
 
         This function takes a dna sequence with ambiguous bases in it, and
@@ -72,61 +309,99 @@ class dna_utility(object):
 
         Parameters
         ----------
-        sequence : string
-            dna sequence
+        sequence : string or bytes
+            dna sequence, bytes give a pattern for matching bytes targets.
         preserve_case : bool
             preserve case of input dna, if false, convert to upper case.
+        engine : string
+            "regex" or "hyperscan". Hyperscan is only used for exact matches
+            (mismatches == 0) and when it is installed, otherwise the regex
+            module is used.
 
         Returns
         -------
         :obj: compiled regex obect
             compiled dna regex with modified ambiguity bases, ready for use in
-            string matching.
+            string matching. Hyperscan patterns only support finditer.
 
         Raises
         ------
         KeyError
             when character is not in dna dictionary.
+        ValueError
+            when the engine is unknown.
 
         """
-        if not preserve_case:   # convert to upper case if not preserve case
-            sequence = sequence.upper()
-        dna_regex = r"(?b)("  # best match set
-        for c in sequence:
-            if c in AMB_REGEX_DICT:
-                dna_regex += AMB_REGEX_DICT[c]
-            else:
-                raise KeyError(c + "is not an allowed DNA character.")
-        dna_regex = dna_regex + r"){s<="+str(mismatches)+r"}"
-        dna_regex = regex.compile(dna_regex)
-        return dna_regex
+        return(_compile_ambig_regex(sequence, mismatches, preserve_case,
+                                    engine))
 
     @staticmethod
-    def __find_match(matcher_regex, target_dna):
-        """Find first match of given sequence in an unambiguous sequence.
+    def make_matcher(sequence, mismatches=0, preserve_case=False,
+                     last=False, engine="regex"):
+        """Build a match function for a dna sequence with ambiguity bases.
 
-        Given a target sequence, find the first/best match of this target
-        sequence in a given unambiguous dna sequence.
+        Returns a function that takes a target dna sequence and behaves like
+        find_first_match (or find_last_match, if last is set) with the regex
+        of the given sequence already bound to it. Matchers are cached, so
+        building the same one again is cheap.
 
         Parameters
         ----------
-        matcher_regex : compiled regex pattern
-            compiled regular expression object
-        target_dna : string
-            dna sequence
+        sequence : string or bytes
+            dna sequence, bytes give a matcher for bytes targets.
+        mismatches : int
+            number of substitutions allowed in a match.
+        preserve_case : bool
+            preserve case of input dna, if false, convert to upper case.
+        last : bool
+            report the last match instead of the first.
+        engine : string
+            "regex" or "hyperscan", see conv_ambig_regex.
 
         Returns
         -------
-        (int, int)
-            start and end positions of best match (first if many),
-            -1 if no matches.
+        function
+            function of the target dna, returning the start and end positions
+            of the match (-1 if no matches) and the number of matches found.
+
+        Raises
+        ------
+        KeyError
+            when character is not in dna dictionary.
+        ValueError
+            when the engine is unknown.
 
         """
-        firstmatch = matcher_regex.search(target_dna)
-        if firstmatch is None:
-            return((-1, -1))
-        else:
-            return(firstmatch.span())
+        return(_make_matcher(sequence, mismatches, preserve_case, last,
+                             engine))
+
+    @staticmethod
+    def reverse_complement(seq, ambig=False):
+        """Reverse complement a dna sequence.
+
+        Complement the sequence with the precomputed translation tables and
+        reverse it. Characters without a complement are kept as they are.
+
+        Parameters
+        ----------
+        seq : string or bytes
+            dna sequence, bytes are faster for very long sequences.
+        ambig : bool
+            complement ambiguity bases as well.
+
+        Returns
+        -------
+        string or bytes
+            reverse complement of the sequence, of the same type as seq.
+
+        """
+        if isinstance(seq, bytes):
+            if ambig:
+                return(seq.translate(_BYTES_COMPLEMENT_AMBIGOUS_DNA)[::-1])
+            return(seq.translate(_BYTES_COMPLEMENT_UNAMBIGOUS_DNA)[::-1])
+        if ambig:
+            return(seq.translate(COMPLEMENT_AMBIGOUS_DNA)[::-1])
+        return(seq.translate(COMPLEMENT_UNAMBIGOUS_DNA)[::-1])
 
     @staticmethod
     def find_last_match(matcher_regex, target_dna):
@@ -139,8 +414,8 @@ class dna_utility(object):
         ----------
         matcher_regex : compiled regex pattern
             compiled regular expression object
-        target_dna : string
-            dna sequence
+        target_dna : string or bytes
+            dna sequence, of the same type as the pattern.
 
         Returns
         -------
@@ -149,23 +424,7 @@ class dna_utility(object):
             -1 if no matches. Also returns the number of matches found
 
         """
-        cur_end = 0
-        last_start = 0
-        last_end = 0
-        number_found = 0
-        while True:
-            target_dna = target_dna[cur_end:]
-            cur_start, cur_end = dna_utility.__find_match(matcher_regex,
-                                                          target_dna)
-            if cur_start == -1:
-                break
-            number_found += 1
-            last_start = last_end + cur_start
-            last_end = last_end + cur_end
-        if last_start == 0 and last_end == 0:
-            last_start = -1
-            last_end = -1
-        return ((last_start, last_end, number_found))
+        return(_last_match(matcher_regex.finditer, target_dna))
 
     @staticmethod
     def find_first_match(matcher_regex, target_dna):
@@ -178,8 +437,8 @@ class dna_utility(object):
         ----------
         matcher_regex : compiled regex pattern
             compiled regular expression object
-        target_dna : string
-            dna sequence
+        target_dna : string or bytes
+            dna sequence, of the same type as the pattern.
 
         Returns
         -------
@@ -188,34 +447,106 @@ class dna_utility(object):
             -1 if no matches. Also returns the number of matches found
 
         """
-        (first_start, first_end) = dna_utility.__find_match(matcher_regex,
-                                                            target_dna)
-        cur_end = 0
-        number_found = 0
-        while True:
-            target_dna = target_dna[cur_end:]
-            cur_start, cur_end = dna_utility.__find_match(matcher_regex,
-                                                          target_dna)
-            if cur_start == -1:
-                break
-            number_found += 1
-        return ((first_start, first_end, number_found))
+        return(_first_match(matcher_regex.finditer, target_dna))
+
+    @staticmethod
+    def find_first_match_batch(sequence, reads, mismatches=0,
+                               preserve_case=False):
+        """Find first match of a sequence in each of many reads.
+
+        Batch version of find_first_match, which compiles the sequence once
+        and runs the cached matcher over all the reads.
+
+        Parameters
+        ----------
+        sequence : string or bytes
+            dna sequence, ambiguity bases allowed.
+        reads : iterable of strings or bytes
+            unambiguous dna sequences to search in, of the same type as
+            sequence.
+        mismatches : int
+            number of substitutions allowed in a match.
+        preserve_case : bool
+            preserve case of input dna, if false, convert to upper case.
+
+        Returns
+        -------
+        :obj: numpy array
+            array of shape (number of reads, 3), with the start and end
+            positions of the first match (-1 if no matches) and the number of
+            matches found in each read.
+
+        """
+        matcher = _make_matcher(sequence, mismatches, preserve_case, False)
+        return(np.array([matcher(read) for read in reads],
+                        dtype=np.int64).reshape(-1, 3))
 
     @staticmethod
-    def find_hamming_distance(target_seq, source_seq, look_at_end=True):
+    def find_first_match_many(sequence, reads, mismatches=0,
+                              preserve_case=False, workers=None,
+                              chunk_size=10000):
+        """Find first match of a sequence in many reads, using threads.
+
+        Same as find_first_match_batch, but the reads are split in chunks
+        that are matched in a thread pool. The regex module is asked to
+        release the GIL while it scans, but the per read python code still
+        holds it, so the speed up depends on the read length and is not
+        linear in the number of threads.
+
+        Parameters
+        ----------
+        sequence : string or bytes
+            dna sequence, ambiguity bases allowed.
+        reads : iterable of strings or bytes
+            unambiguous dna sequences to search in, of the same type as
+            sequence.
+        mismatches : int
+            number of substitutions allowed in a match.
+        preserve_case : bool
+            preserve case of input dna, if false, convert to upper case.
+        workers : int
+            number of threads, defaults to the number of cpus.
+        chunk_size : int
+            number of reads matched per job.
+
+        Returns
+        -------
+        :obj: numpy array
+            array of shape (number of reads, 3), with the start and end
+            positions of the first match (-1 if no matches) and the number of
+            matches found in each read.
+
+        """
+        matcher = _make_matcher(sequence, mismatches, preserve_case, False,
+                                "regex", True)
+        reads = list(reads)
+        chunks = [reads[start:(start+chunk_size)]
+                  for start in range(0, len(reads), chunk_size)]
+        with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+            spans = [span for chunk in pool.map(partial(_match_chunk, matcher),
+                                                chunks)
+                     for span in chunk]
+        return(np.array(spans, dtype=np.int64).reshape(-1, 3))
+
+    @staticmethod
+    def find_hamming_distance(target_seq, source_seq, look_at_end=True,
+                              max_dist=None):
         """Find hamming distance between sequences.
 
         Find the hamming distance between given sequences, assuming no
-        ambiguity in the sequences.
+        ambiguity in the sequences. Uses rapidfuzz when it is installed.
 
         Parameters
         ----------
-        target_seq :  string
+        target_seq :  string or bytes
             The string to be searched for
-        sourse_seq :  strings
-            The string to be searced in
+        sourse_seq :  string or bytes
+            The string to be searced in, of the same type as target_seq
         look_at_end : bool
             If true, look for match at the end of string, else beginning
+        max_dist : int or None
+            If given, stop counting once the distance exceeds max_dist. Any
+            larger distance is then reported as max_dist + 1.
 
         Returns
         -------
@@ -226,9 +557,38 @@ class dna_utility(object):
         tlen = len(target_seq)
         slen = len(source_seq)
         if tlen > slen:
+            if max_dist is not None and tlen > max_dist:
+                return(max_dist + 1)
             return(tlen)
         if look_at_end:
             sseq = source_seq[(slen-tlen):]
         else:
             sseq = source_seq[0:tlen]
-        return(hamming.distance(target_seq, sseq))
+        if Hamming is not None:
+            return(Hamming.distance(target_seq, sseq, score_cutoff=max_dist))
+        tcode = scode = None
+        if tlen >= BIT_PARALLEL_HAMMING_MIN_LEN:
+            tcode = _encode2bit(target_seq)
+            scode = _encode2bit(sseq)
+        if tcode is not None and scode is not None:
+            # Differing bases leave a non zero 2 bit code, fold it to one bit
+            diff = tcode ^ scode
+            dist = ((diff | (diff >> 1)) & _low_bit_mask(tlen)).bit_count()
+        elif tlen < NUMPY_HAMMING_MIN_LEN:
+            dist = 0
+            for tbase, sbase in zip(target_seq, sseq):
+                if tbase != sbase:
+                    dist += 1
+                    if max_dist is not None and dist > max_dist:
+                        break
+        else:
+            tarr = np.frombuffer(_as_bytes(target_seq), np.uint8)
+            sarr = np.frombuffer(_as_bytes(sseq), np.uint8)
+            hamming_numba = _numba_hamming_kernel()
+            if hamming_numba is not None:
+                dist = int(hamming_numba(tarr, sarr))
+            else:
+                dist = int(np.count_nonzero(tarr != sarr))
+        if max_dist is not None and dist > max_dist:
+            dist = max_dist + 1
+        return(dist)
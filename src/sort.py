@@ -44,7 +44,8 @@ class sample_sorter():
 
     _tag_dict = {}
     _primer_pair = None
-    _primers_rgx = None
+    _first_matchers = None
+    _last_matchers = None
     _samp_info = {}
     _pool_info = {}
     _merge = False
@@ -134,13 +135,16 @@ class sample_sorter():
         self._primer_pair = (fwd_primer, rev_primer)
 
     def _conv_primers_regex(self):
-        """Convert primer seqs to regexes."""
-        self._primers_rgx = (DU.conv_ambig_regex(str(self._primer_pair[0]),
-                                                 mismatches=self.primer_errors,
-                                                 preserve_case=False),
-                             DU.conv_ambig_regex(str(self._primer_pair[1]),
-                                                 mismatches=self.primer_errors,
-                                                 preserve_case=False))
+        """Convert primer seqs to first and last match functions."""
+        primers = [str(primer) for primer in self._primer_pair]
+        errors = self.primer_errors
+        self._first_matchers = tuple(DU.make_matcher(primer,
+                                                     mismatches=errors)
+                                     for primer in primers)
+        self._last_matchers = tuple(DU.make_matcher(primer,
+                                                    mismatches=errors,
+                                                    last=True)
+                                    for primer in primers)
 
     def __log_in_details(self):
         """Print the information about the sorter.
@@ -585,8 +589,8 @@ class sample_sorter():
         else:
             infile = open(read_filename)
         for record in SeqIO.parse(infile, "fastq"):
-            seq = record.seq
-            seq_rc = record.seq.reverse_complement()
+            seq = str(record.seq)
+            seq_rc = DU.reverse_complement(seq, ambig=True)
             (fstart, fend, rstart, rend, match_type) = self.__find_primer_pos(
                 seq, seq_rc)
             self._primer_type_counts[match_type] += 1
@@ -728,10 +732,8 @@ class sample_sorter():
         match_type = 0  # no primers found
         # First find the forward primer in read 1, and reverse in read 2.
         # F in read 1 and R' in read2
-        (fstart, fend, num_fwd) = DU.find_first_match(self._primers_rgx[0],
-                                                      read1_seq)
-        (rstart, rend, num_rev) = DU.find_last_match(self._primers_rgx[1],
-                                                     read2_seq)
+        (fstart, fend, num_fwd) = self._first_matchers[0](read1_seq)
+        (rstart, rend, num_rev) = self._last_matchers[1](read2_seq)
         if fstart != -1 and rstart != -1:
             if num_fwd > 1 or num_rev > 1:
                 match_type = 8
@@ -745,10 +747,8 @@ class sample_sorter():
             return((fstart, fend, rstart, rend, match_type))
 
         # R in read 1 and F' in read2
-        (rstart, rend, num_rev) = DU.find_first_match(self._primers_rgx[1],
-                                                      read1_seq)
-        (fstart, fend, num_fwd) = DU.find_last_match(self._primers_rgx[0],
-                                                     read2_seq)
+        (rstart, rend, num_rev) = self._first_matchers[1](read1_seq)
+        (fstart, fend, num_fwd) = self._last_matchers[0](read2_seq)
         if fstart != -1 and rstart != -1:
             if num_fwd > 1 or num_rev > 1:
                 match_type = 9
@@ -777,12 +777,16 @@ class sample_sorter():
 
         """
         # First figure out forward tag
+        # Distances above the allowed mismatches are all rejected below, so
+        # let the distance computation stop counting early.
+        max_dist = int(self.tag_errors)
         best_dist = len(tag) + 100
         best_tag = ""
         num_matches = 0
         for tag_name in self._tag_dict:
             tag_seq = self._tag_dict[tag_name]
-            cur_dist = DU.find_hamming_distance(tag_seq, tag)
+            cur_dist = DU.find_hamming_distance(tag_seq, tag,
+                                                max_dist=max_dist)
             if cur_dist < best_dist:
                 num_matches = 1
                 best_tag = tag_name